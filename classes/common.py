@@ -1,13 +1,237 @@
 import os
+import copy
+import errno
+import fcntl
+import concurrent.futures
 import shutil
+import stat
+import pathlib
+import functools
 
+# Below this, fast_copy doesn't bother with an in-kernel copy
+SMALL_FILE_SIZE = 4096
+
+# Linux's reflink ioctl; the fcntl module only names it from Python 3.12
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+# Thread pool size for batches of file copies; small files are all latency, so well above the core count
+COPY_WORKERS = (os.cpu_count() or 1) * 4
+
+
+# The environment and PATH don't change under a running process; no need to walk PATH more than once
+@functools.lru_cache(maxsize=1)
 def get_editor():
-    editor = os.environ.get('EDITOR')
-    if editor: return editor
-    editor = os.environ.get('VISUAL')
-    if editor: return editor
+    for var in ('EDITOR', 'VISUAL'):
+        editor = os.environ.get(var)
+        if editor: return editor
 
     for fallback in ['nano', 'vim', 'vi']:
         if shutil.which(fallback):
             return fallback
-    raise RuntimeError("No editor found. Set the EDITOR environment variable.")
\ No newline at end of file
+    raise RuntimeError("No editor found. Set the EDITOR environment variable.")
+
+
+def scan_names(path: pathlib.Path, missing_ok: bool = False) -> list:
+    # os.scandir keeps the name straight from the directory read; no Path objects, no extra stat calls
+    try:
+        with os.scandir(path) as it:
+            return [entry.name for entry in it]
+    except FileNotFoundError:
+        if missing_ok:
+            return []
+        raise
+
+
+def fast_copy(src: pathlib.Path, dst: pathlib.Path):
+    # Same result as shutil.copy2, but the data never leaves the kernel
+    # FICLONE (and copy_file_range, where the filesystem supports it) reflinks on btrfs/xfs, so a multi-GB disk image is a metadata operation there
+    # Cross-device copies, old kernels, and odd filesystems fall back to shutil
+    try:
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            # Not O_TRUNC: if src and dst are the same file, truncating first would wipe it before the check below could catch it
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT, 0o666)
+            try:
+                src_st, dst_st = os.fstat(src_fd), os.fstat(dst_fd)
+                if (src_st.st_dev, src_st.st_ino) == (dst_st.st_dev, dst_st.st_ino):
+                    raise shutil.SameFileError(f"{src!r} and {dst!r} are the same file")
+                os.ftruncate(dst_fd, 0)
+                remaining = src_st.st_size
+                if remaining < SMALL_FILE_SIZE:
+                    # Scripts and dotfiles: one read and one write is all they need
+                    os.pwrite(dst_fd, os.pread(src_fd, remaining, 0), 0)
+                    remaining = 0
+                else:
+                    try:
+                        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                        remaining = 0
+                    except OSError:
+                        # Not a reflink-capable filesystem, or not the same one; copy_file_range is next best
+                        pass
+                while remaining > 0:
+                    copied = os.copy_file_range(src_fd, dst_fd, remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+    except AttributeError:
+        # No os.copy_file_range outside Linux
+        shutil.copyfile(src, dst)
+    except OSError as E:
+        if E.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+        shutil.copyfile(src, dst)
+
+    shutil.copystat(src, dst)
+
+
+def clone_tree(src: pathlib.Path, dst: pathlib.Path, max_workers: int = None):
+    # Copies a template/group tree, symlinking disk images instead of copying them
+    # Directories are created first, in order, since a child can't exist before its parent
+    # The file copies are independent of each other, so they go to a thread pool to overlap the I/O waits
+    if max_workers is None:
+        max_workers = COPY_WORKERS
+
+    jobs = []
+    directories = []
+    for root, dirs, files in os.walk(src, followlinks=False):
+        target_root = dst / pathlib.Path(root).relative_to(src)
+        os.makedirs(target_root, exist_ok=True)
+        directories.append((root, target_root))
+        # walk lists symlinked directories but doesn't descend into them; recreate the links so they aren't silently dropped
+        for name in dirs:
+            if os.path.islink(os.path.join(root, name)):
+                os.symlink(os.readlink(os.path.join(root, name)), target_root / name)
+        jobs.extend((pathlib.Path(root) / name, target_root / name) for name in files)
+
+    def clone_file(path: pathlib.Path, target: pathlib.Path):
+        if path.name.endswith(".qcow2"):
+            target.symlink_to(path.resolve())
+        else:
+            fast_copy(path, target)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(clone_file, path, target) for path, target in jobs]
+        # result() re-raises anything that went wrong in a worker
+        for future in futures:
+            future.result()
+
+    # Like copytree, carry the directories' permissions and times over; only once they're full, or the copies would bump the mtimes again
+    for root, target_root in reversed(directories):
+        shutil.copystat(root, target_root)
+
+
+def fast_rmtree(path):
+    # For trees mockmox made itself; skips shutil.rmtree's per-entry stats and generic error handling
+    # The directory read says whether to recurse or unlink; symlinks (the disk images in groups) are unlinked, never followed
+    # scandir would follow a symlinked root and empty its target, so refuse one up front like shutil.rmtree does
+    if stat.S_ISLNK(os.lstat(path).st_mode):
+        raise OSError(f"Cannot call rmtree on a symbolic link: {path}")
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                fast_rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    os.rmdir(path)
+
+
+def spawn(argv: list, **kwargs):
+    # subprocess.run, set up so CPython can launch with posix_spawn instead of fork+exec
+    # Forking means copying the page tables of a process that may be juggling big libvirt/qemu state; posix_spawn skips that
+    # It needs an executable path with a directory in it and close_fds=False; our own fds are non-inheritable anyway (PEP 446)
+    # Passing preexec_fn, pass_fds, cwd, start_new_session, user/group, etc. through kwargs silently drops back to fork+exec
+    # subprocess is imported here so it stays off the startup path of every command that never launches anything
+    import subprocess
+    executable = shutil.which(argv[0]) or argv[0]
+    return subprocess.run([executable, *argv[1:]], close_fds=False, **kwargs)
+
+
+def _read_bytes(path) -> bytes:
+    # Straight through the fd and handed to the parser as bytes; libyaml does its own decoding
+    # For a config file this small, pathlib's open/decode layers cost about as much as the read itself
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = []
+        while chunk := os.read(fd, 1 << 16):
+            chunks.append(chunk)
+        return b"".join(chunks)
+    finally:
+        os.close(fd)
+
+
+# yaml and json are imported on first use; most mockmox commands never parse anything, and this module sits on their import path
+@functools.lru_cache(maxsize=1)
+def _yaml_loader():
+    import yaml
+    # libyaml's C loader is several times faster than the pure Python one, but it's an optional build of PyYAML
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def safe_load(stream):
+    import yaml
+    return yaml.load(stream, Loader=_yaml_loader())
+
+
+def _load_yaml_sidecar(path: pathlib.Path, mtime_ns: int, size: int):
+    # The in-memory cache below dies with the process, and most mockmox runs are one short CLI call
+    # So the parsed result is also saved as JSON next to the file, tagged with the mtime and size it was parsed from
+    # JSON rather than pickle: it loads several times faster than even libyaml, and it's safe to read from template directories users can write to
+    import json
+    cache = path.with_suffix(f"{path.suffix}.json")
+    try:
+        cached = json.loads(_read_bytes(cache))
+        if (cached["mtime_ns"], cached["size"]) == (mtime_ns, size):
+            return cached["data"]
+    except (OSError, ValueError, TypeError, KeyError):
+        # Missing, unreadable, or mangled sidecar; fall through and reparse
+        pass
+
+    data = safe_load(_read_bytes(path))
+
+    # JSON can't hold everything YAML can (dates, non-string keys...); if it wouldn't come back identical, don't cache it
+    try:
+        dumped = json.dumps({"mtime_ns": mtime_ns, "size": size, "data": data}, separators=(',', ':'))
+        if json.loads(dumped)["data"] != data:
+            return data
+    except (TypeError, ValueError):
+        return data
+
+    # Write-then-rename, so a concurrent reader never sees half a sidecar
+    # The tmp file comes from mkstemp (random name, O_EXCL), since these directories can be user-writable and the CLI usually runs as root;
+    # a predictable name would let anyone plant a symlink there and have root write through it
+    # It gets the YAML file's permissions, so the cache never shows more than the file it came from
+    import tempfile
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=cache.parent, prefix=f".{cache.name}.", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            os.fchmod(f.fileno(), stat.S_IMODE(os.stat(path).st_mode) & 0o666)
+            f.write(dumped)
+        os.replace(tmp, cache)
+    except OSError:
+        # Most likely a normal user reading a root-owned config; the cache is an optimisation, not a requirement
+        if tmp is not None:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    return data
+
+
+@functools.lru_cache(maxsize=1024)
+def _load_yaml_cached(path_str: str, mtime_ns: int, size: int, sidecar: bool = False):
+    # mtime and size are only here to form the cache key; an edited file gets a new key and is reparsed
+    if sidecar:
+        return _load_yaml_sidecar(pathlib.Path(path_str), mtime_ns, size)
+    return safe_load(_read_bytes(path_str))
+
+
+def load_yaml(path: pathlib.Path, sidecar: bool = False):
+    st = path.stat()
+    # Callers are free to mutate what they get back, so never hand out the cached object itself
+    return copy.deepcopy(_load_yaml_cached(str(path), st.st_mtime_ns, st.st_size, sidecar))
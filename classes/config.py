@@ -1,14 +1,19 @@
 import pathlib
-import yaml
-import libvirt
+from typing import Final
 
-DEFAULT_CONFIG_FILE = pathlib.Path("/etc/mockmox/config.yaml")
-DEFAULT_SOCKET = "qemu:///system"
+DEFAULT_CONFIG_FILE: Final = pathlib.Path("/etc/mockmox/config.yaml")
+DEFAULT_SOCKET: Final = "qemu:///system"
 
 def load_config(config_file: pathlib.Path, libvirtd_connection: str):
-    if config_file.exists():
+    # Imported here so the constants above stay cheap to import; only commands that need a setting pay for YAML
+    import yaml
+    from .common import load_yaml
+
+    # config_file=None skips the file entirely and gives the built-in defaults
+    if config_file is not None and config_file.exists():
         try:
-            config = yaml.safe_load(config_file.read_text())
+            # The main config gets an on-disk parse cache; it's read by every single CLI invocation
+            config = load_yaml(config_file, sidecar=True)
         except yaml.YAMLError as E:
             raise yaml.YAMLError(f"Config file {config_file} has invalid YAML syntax. Edit or reinstall to fix.\n{E}")
         except PermissionError as E:
@@ -16,23 +21,26 @@ def load_config(config_file: pathlib.Path, libvirtd_connection: str):
     else:
         config = {}
 
+    # Each section is looked up once, rather than once per key read from it
+    directories = config.get("directories") or {}
+    defaults = config.get("defaults") or {}
+
     # If config has directories key with base_dir key, use that value. Else, use the final value
-    base_dir = pathlib.Path(config.get("directories", {}).get("base_dir", "/opt/mockmox"))
+    base_dir = pathlib.Path(directories.get("base_dir", "/opt/mockmox"))
     config['group_dir'] = base_dir / "groups"
     config['vm_template_dir'] = base_dir / "vms_templates"
     config['instance_dir'] = base_dir / "instances"
     config['suspended_dir'] = base_dir / "suspended"
     config['default_dir'] = base_dir / "defaults"
 
-    config['script_location'] = pathlib.Path(config.get("directories", {}).get("base_dir", "/bin/mockmox"))
+    config['script_location'] = pathlib.Path(directories.get("script_location", "/bin/mockmox"))
 
-    config['vm_default_disk_size'] = config.get("defaults", {}).get("vm_disk_size", 64) # GB
-    config['vm_default_cpus'] = config.get("defaults", {}).get("vm_cpus", 4)
-    config['vm_default_memory'] = config.get("defaults", {}).get("vm_memory", 8192) # MB
+    config['vm_default_disk_size'] = defaults.get("vm_disk_size", 64) # GB
+    config['vm_default_cpus'] = defaults.get("vm_cpus", 4)
+    config['vm_default_memory'] = defaults.get("vm_memory", 8192) # MB
 
-    if not libvirtd_connection:
-        config['libvirtd_connection'] = config.get("defaults", {}).get("libvirtd_connection", DEFAULT_SOCKET)
-    else:
-        config['libvirtd_connection'] = libvirtd_connection
+    # Command line, then the config file's top-level setting (where the shipped config puts it), then the older defaults.libvirtd_connection,
+    # then the local socket; an empty value falls through too
+    config['libvirtd_connection'] = libvirtd_connection or config.get("libvirtd_connection") or defaults.get("libvirtd_connection") or DEFAULT_SOCKET
 
     return config
@@ -1,65 +1,73 @@
+import os
 import pathlib
 #import libvirt
-import shutil
 import logging
+import functools
+from .common import scan_names, clone_tree, fast_rmtree
 
 
 class Group:
     def __init__(self, name: str, global_group_dir: pathlib.Path, global_templates_dir: pathlib.Path):
         self.name = name
         self.logger = logging.getLogger(f"{__name__}.{self.__class__.__name__}")
-        self.vm_templates = []
         self.path = global_group_dir / name
         self.snapshot_dir = self.path / "snapshots"
         self.vm_template_dir = self.path / "vm_templates"
+        self.config_file = self.path / "config.yaml"
         self.global_templates_dir = global_templates_dir
 
-        if self.vm_template_dir.exists():
-            self.vm_templates = self.vm_template_dir.iterdir()
+
+    # Read on first access and kept as a list of names; add/delete below drop it so it's rescanned
+    @functools.cached_property
+    def vm_templates(self) -> list:
+        return scan_names(self.vm_template_dir, missing_ok=True)
 
 
     def create(self):
-        if self.path.exists():
+        # Claim the group directory itself first, so any existing group is refused, however complete it is
+        try:
+            os.mkdir(self.path)
+        except FileExistsError:
             raise FileExistsError(f"Cannot create existing group {self.name}")
-
-        self.path.mkdir()
-        self.snapshot_dir.mkdir()
-        self.vm_template_dir.mkdir()
+        os.mkdir(self.snapshot_dir)
+        os.mkdir(self.vm_template_dir)
 
 
     def delete(self):
-        if not self.path.exists():
+        try:
+            fast_rmtree(self.path)
+        except FileNotFoundError:
             raise FileNotFoundError(f"Cannot delete nonexistent group {self.name}")
 
-        shutil.rmtree(self.path)
-
 
     def add_vm_template(self, template_name: str):
-        if template_name not in self.global_templates_dir.iterdir():
+        if not (self.global_templates_dir / template_name).exists():
             raise FileNotFoundError(f"Cannot add nonexistent template {template_name}")
 
         # This is a stylistic choice. QCOW2 files can be *heavy* and are difficult to modify; I'm declaring them immutable
         # Instead, modify files and executables per VM template instead of the disk image
         src = self.global_templates_dir / template_name
         dst = self.vm_template_dir / template_name
-        for path in src.rglob('*'):
-            relative = path.relative_to(src)
-            target = dst / relative
 
-            if path.is_dir():
-                target.mkdir(parents=True, exist_ok=True)
-            elif path.is_file():
-                if path.match("*qcow2"):
-                    target.symlink_to(path.resolve())
-                else:
-                    shutil.copy2(path, target)
+        # Claim the destination before copying anything; clone_tree would happily overwrite a customised copy already in the group
+        # mkdir without parents also fails if the group itself doesn't exist, rather than conjuring up its directories
+        try:
+            os.mkdir(dst)
+        except FileExistsError:
+            raise FileExistsError(f"VM template {template_name} is already in group {self.name}")
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Cannot add a template to nonexistent group {self.name}")
+        clone_tree(src, dst)
+
+        self.__dict__.pop("vm_templates", None)
 
 
     def delete_vm_template(self, template_name: str):
-        if template_name not in self.vm_template_dir.iterdir():
+        try:
+            fast_rmtree(self.vm_template_dir / template_name)
+        except FileNotFoundError:
             raise FileNotFoundError(f"VM template {template_name} not added to this group.")
-
-        shutil.rmtree(self.vm_template_dir / template_name)
+        self.__dict__.pop("vm_templates", None)
 
 
 
@@ -1,7 +1,8 @@
 import pathlib
-import datetime
-import shutil
-from vm_template import VMTemplate
+import time
+import uuid
+from .vm_template import VMTemplate
+from .common import clone_tree
 
 class Instance:
     def __init__(self, group: pathlib.Path, instance_dir: pathlib.Path, vm_template_dir: pathlib.Path, name: str = None):
@@ -12,25 +13,18 @@ class Instance:
         self.path = None
 
     def start(self):
-        self.name = f"{self.group.name}-{datetime.datetime.now().timestamp()}"
-        self.path = self.instance_dir / self.name
-
-        # Iterate until new name found
-        while self.path.exists():
-            self.name = f"{self.group.name}-{int(datetime.datetime.now().timestamp()) + 1}"
+        # mkdir is the existence check; it either claims the name atomically or raises, so there's no window for a second start to grab it
+        # The uuid suffix makes a collision within the same second vanishingly unlikely, but retry anyway
+        while True:
+            self.name = f"{self.group.name}-{int(time.time())}-{uuid.uuid4().hex[:8]}"
             self.path = self.instance_dir / self.name
+            try:
+                self.path.mkdir(parents=False)
+                break
+            except FileExistsError:
+                continue
 
-        for path in self.group.rglob('*'):
-            relative = path.relative_to(self.group)
-            target = self.path / relative
-
-            if path.is_dir():
-                target.mkdir(parents=True, exist_ok=True)
-            elif path.is_file():
-                if path.match("*qcow2"):
-                    target.symlink_to(path.resolve())
-                else:
-                    shutil.copy2(path, target)
+        clone_tree(self.group, self.path)
 
         for vm in [VMTemplate(x.name, self.vm_template_dir) for x in (self.path / "vm_templates").iterdir()]:
             vm.start()
@@ -1,4 +1,4 @@
-from vm_template import VMTemplate
+from .vm_template import VMTemplate
 import libvirt
 import pathlib
 
@@ -8,10 +8,18 @@ class VM(VMTemplate):
         self.domain = f"{self.name}_{id}"
 
 
-    def get_IP(self, instance_id: str):
-        domain = self.connection.lookupByName(instance_id)
+    @property
+    def domain_name(self) -> str:
+        return self.domain
+
+
+    def get_IP(self):
+        try:
+            ifaces = self._domain.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)
+        except libvirt.libvirtError as E:
+            self._forget_missing_domain(E)
+            raise
 
-        ifaces = domain.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)
         ips = []
         for iface_name, val in ifaces.items():
             if val['addrs']:
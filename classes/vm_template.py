@@ -2,17 +2,50 @@ import logging
 import yaml
 import pathlib
 import shutil
-import subprocess
 import os
 import uuid
-import xml.etree.ElementTree as ET
-import libvirt
-import glob
-from .common import get_editor
+from xml.sax.saxutils import escape, quoteattr
+import functools
+import collections
+import concurrent.futures
+from typing import TYPE_CHECKING
+from .common import get_editor, load_yaml, safe_load, scan_names, fast_copy, fast_rmtree, spawn, COPY_WORKERS
+
+# libvirt is a heavy C extension and plenty of template work (files, editing config) never touches it
+# It's imported inside the methods that talk to the hypervisor instead
+if TYPE_CHECKING:
+    import libvirt
+
+
+# The domain schema never changes shape, only values; filling a string is far cheaper than building an ElementTree for it
+# Attribute values go through quoteattr (which supplies its own quotes) and text goes through escape
+DOMAIN_XML_TEMPLATE = """<domain type='kvm'>
+  <name>{name}</name>
+  <uuid>{uuid}</uuid>
+  <memory unit='MiB'>{memory}</memory>
+  <vcpu>{cpus}</vcpu>
+  <devices>
+    <disk type='file' device='disk'>
+      <source file={disk}/>
+      <target dev='vda' bus={disk_type}/>
+    </disk>
+    <interface type='network'>
+      <source network='default'/>
+      <model type={net_type}/>
+    </interface>
+    <graphics type={graphics} port='-1' autoport='yes'/>
+  </devices>
+</domain>
+"""
 
 
 class VMTemplate:
-    def __init__(self, name: str, vm_template_dir: pathlib.Path, connection: libvirt.virConnect, delete: bool = False):
+    # One instance per template path for the whole process, so a template's config is parsed once however many callers touch it
+    # The constructor only reads; create and delete drop the entry, since they change whether the template exists at all
+    # Templates only: a VM's constructor needs more than a name, so get always builds and stores plain VMTemplates
+    _instances: dict = {}
+
+    def __init__(self, name: str, vm_template_dir: pathlib.Path, connection: "libvirt.virConnect" = None, delete: bool = False):
         self.name = name
         self.logger = logging.getLogger(f"{__name__}.{self.__class__.__name__}")
         self.path = vm_template_dir / name
@@ -25,38 +58,105 @@ class VMTemplate:
         self.user_files_dir = self.path / "user_files"
         self.root_files_dir = self.path / "root_files"
 
+        # Looked up by _build_and_verify_path; doubles as the list of valid (user, file type) pairs
+        self._dirs = {
+            ("user", "executable"): self.user_executable_dir,
+            ("user", "file"): self.user_files_dir,
+            ("root", "executable"): self.root_executable_dir,
+            ("root", "file"): self.root_files_dir,
+        }
+
         # SSH keys should be named by user
         self.ssh_key_dir = self.path / "ssh"
-        self.ssh_keyfiles = self.ssh_key_dir.iterdir() if self.ssh_key_dir.exists() else []
 
-        self.connection: libvirt.virConnect = connection
+        self.connection: "libvirt.virConnect" = connection
 
         # All state is maintained by the directory structure; having the path exist means that the template exists, even if it may be horribly corrupted
         # "delete" is used to skip checks and attempts to load configuration; otherwise, it would be impossible to delete a corrupted template through the object
-        if self.path.exists() and not delete:
-            if not self.disk.exists():
-                raise FileNotFoundError(f"VM template {self.name} is missing its disk image.")
-            if not self.config_file.exists():
-                raise FileNotFoundError(f"VM template {self.name} is missing its config file.")
-
+        # One directory read answers both "does the template exist" and "is it complete", instead of a stat per file
+        if not delete:
             try:
-                self.config = yaml.safe_load(self.config_file.read_text())
-            except yaml.YAMLError as E:
-                raise yaml.YAMLError(f"VM template {self.name} has an invalid configuration file: {self.config_file}\n{E}")
+                entries = set(scan_names(self.path))
+            except FileNotFoundError:
+                entries = None
+
+            if entries is not None:
+                if self.disk.name not in entries:
+                    raise FileNotFoundError(f"VM template {self.name} is missing its disk image.")
+                if self.config_file.name not in entries:
+                    raise FileNotFoundError(f"VM template {self.name} is missing its config file.")
+
+                try:
+                    self.config = load_yaml(self.config_file, sidecar=True)
+                except yaml.YAMLError as E:
+                    raise yaml.YAMLError(f"VM template {self.name} has an invalid configuration file: {self.config_file}\n{E}")
 
         self.ip: str = ""
         self.ssh_port: int = self.config.get("ssh_port", 22)
 
-        # Executables and files aren't mandatory
-        self.user_executables = self.user_executable_dir.iterdir() if self.user_executable_dir.exists() else []
-        self.root_executables = self.root_executable_dir.iterdir() if self.root_executable_dir.exists() else []
-        self.user_files = self.user_files_dir.iterdir() if self.user_files_dir.exists() else []
-        self.root_files = self.root_files_dir.iterdir() if self.root_files_dir.exists() else []
 
+    @staticmethod
+    def get(name: str, vm_template_dir: pathlib.Path) -> "VMTemplate":
+        key = vm_template_dir / name
+        if key not in VMTemplate._instances:
+            VMTemplate._instances[key] = VMTemplate(name, vm_template_dir)
+        return VMTemplate._instances[key]
+
+
+    # Directory listings are read on first access and kept as plain lists of names, so they can be iterated more than once
+    # Anything in this class that changes one of these directories drops the matching cached listing
+    # Executables, files, and SSH keys aren't mandatory; a missing directory is just an empty listing
+    @functools.cached_property
+    def ssh_keyfiles(self) -> list:
+        return scan_names(self.ssh_key_dir, missing_ok=True)
+
+
+    @functools.cached_property
+    def user_executables(self) -> list:
+        return scan_names(self.user_executable_dir, missing_ok=True)
+
+
+    @functools.cached_property
+    def root_executables(self) -> list:
+        return scan_names(self.root_executable_dir, missing_ok=True)
+
+
+    @functools.cached_property
+    def user_files(self) -> list:
+        return scan_names(self.user_files_dir, missing_ok=True)
 
-    def attach_iso(self, iso: pathlib.Path, connection: libvirt.virConnect):
-        dom = connection.lookupByName(self.name)
 
+    @functools.cached_property
+    def root_files(self) -> list:
+        return scan_names(self.root_files_dir, missing_ok=True)
+
+
+    # The libvirt domain name; VMs running in an instance override this with their numbered name
+    @property
+    def domain_name(self) -> str:
+        return self.name
+
+
+    # lookupByName is an RPC over the libvirt socket, so the handle is looked up once and kept
+    @functools.cached_property
+    def _domain(self) -> "libvirt.virDomain":
+        return self.connection.lookupByName(self.domain_name)
+
+
+    def invalidate_domain(self):
+        # Call after undefining/stopping a domain so the next access looks it up again
+        self.__dict__.pop("_domain", None)
+
+
+    def _forget_missing_domain(self, E: "libvirt.libvirtError"):
+        import libvirt
+        # A cached handle to a domain that has since gone away is useless; drop it before the error propagates
+        if E.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            self.invalidate_domain()
+
+
+    def attach_iso(self, iso: pathlib.Path):
+        import libvirt
         cdrom_xml = f"""
         <disk type='file' device='cdrom'>
           <driver name='qemu' type='raw'/>
@@ -67,12 +167,15 @@ class VMTemplate:
         """
 
         # Attach CD-ROM
-        dom.attachDeviceFlags(cdrom_xml, libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG)
-
+        try:
+            self._domain.attachDeviceFlags(cdrom_xml, libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        except libvirt.libvirtError as E:
+            self._forget_missing_domain(E)
+            raise
 
-    def detach_iso(self, iso: pathlib.Path, connection: libvirt.virConnect):
-        dom = connection.lookupByName(self.name)
 
+    def detach_iso(self, iso: pathlib.Path):
+        import libvirt
         eject_xml = f"""
         <disk type='file' device='cdrom'>
           <driver name='qemu' type='raw'/>
@@ -82,27 +185,37 @@ class VMTemplate:
         </disk>
         """
 
-        dom.updateDeviceFlags(eject_xml, libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        try:
+            self._domain.updateDeviceFlags(eject_xml, libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        except libvirt.libvirtError as E:
+            self._forget_missing_domain(E)
+            raise
 
 
     def delete(self, group_dir, acknowledge):
+        self._instances.pop(self.path, None)
+
+        # This guards the group copies below, not just the final rmtree; don't touch any group for a template that isn't there
         if not self.path.exists():
             raise FileNotFoundError(f"Cannot delete nonexistent template {self.name}")
 
         # First, check for existence in groups
         found_groups = []
-        for group in group_dir.iterdir():
-            group_vm_templates = (group / "vm_templates").iterdir()
-            if self.name in group_vm_templates:
-                found_groups.append(group.as_posix())
+        with os.scandir(group_dir) as it:
+            for group in it:
+                if group.is_dir(follow_symlinks=False) and self.name in scan_names(pathlib.Path(group.path) / "vm_templates"):
+                    found_groups.append(group.path)
 
         if found_groups and not acknowledge:
             raise FileExistsError(f"The template exists in the following groups and must be deleted first: {'\n\t'.join(found_groups)}\nUse the \"--acknowledge\" flag to force deletion.")
         elif found_groups and acknowledge:
-            for dir in [(group_dir / x / "vm_templates" / {self.name}) for x in found_groups]:
-                shutil.rmtree(dir)
+            for dir in [(pathlib.Path(x) / "vm_templates" / self.name) for x in found_groups]:
+                fast_rmtree(dir)
 
-        shutil.rmtree(self.path)
+        try:
+            fast_rmtree(self.path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Cannot delete nonexistent template {self.name}")
 
 
     def create(self, disk_size: int,
@@ -116,6 +229,7 @@ class VMTemplate:
 
         if self.path.exists():
             raise FileExistsError(f"Cannot create existing template {self.name}")
+        self._instances.pop(self.path, None)
 
         if not (iso or existing_disk_image):
             raise ValueError("An ISO or existing disk image is required when creating a VM")
@@ -127,109 +241,149 @@ class VMTemplate:
             if not existing_disk_image.exists():
                 raise FileNotFoundError(f"Disk image {existing_disk_image} does not exist.")
 
-        self.path.mkdir()
-        self.ssh_key_dir.mkdir()
-        self.user_executable_dir.mkdir()
-        self.root_executable_dir.mkdir()
-        self.user_files_dir.mkdir()
-        self.root_files_dir.mkdir()
+        # parents=True on the leaves creates the template directory along with the first one
+        for directory in (self.ssh_key_dir, self.user_executable_dir, self.root_executable_dir, self.user_files_dir, self.root_files_dir):
+            directory.mkdir(parents=True, exist_ok=False)
 
         if not existing_disk_image:
-            subprocess.run(f"qemu-img create -f qcow2 {self.disk} {disk_size}".split(), capture_output=False, check=True)
+            # disk_size is in GB; qemu-img takes a bare number as bytes
+            spawn(["qemu-img", "create", "-f", "qcow2", str(self.disk), f"{disk_size}G"], capture_output=False, check=True)
 
         else:
-            shutil.copy2(existing_disk_image, self.disk)
-
-            domain = ET.Element('domain', type='kvm')
-            ET.SubElement(domain, 'name').text = self.name
-            ET.SubElement(domain, 'uuid').text = str(uuid.uuid4())
-            ET.SubElement(domain, 'memory', unit='MiB').text = str(memory)
-            ET.SubElement(domain, 'vcpu').text = str(cpus)
+            self.clone_disk(existing_disk_image)
 
-            devices = ET.SubElement(domain, 'devices')
-            disk = ET.SubElement(devices, 'disk', type='file', device='disk')
-            ET.SubElement(disk, 'source', file=self.disk.as_posix())
-            ET.SubElement(disk, 'target', dev='vda', bus=disk_type)
+            xml_str = DOMAIN_XML_TEMPLATE.format(
+                name=escape(self.name),
+                uuid=uuid.uuid4(),
+                memory=int(memory),
+                cpus=int(cpus),
+                disk=quoteattr(self.disk.as_posix()),
+                disk_type=quoteattr(disk_type),
+                net_type=quoteattr(net_interface_type),
+                graphics=quoteattr(graphics_type))
 
-            # Add network
-            net = ET.SubElement(devices, 'interface', type='network')
-            ET.SubElement(net, 'source', network='default')
-            ET.SubElement(net, 'model', type=net_interface_type)
+            # defineXML hands back the domain handle; keep it rather than looking it up again
+            self._domain = self.connection.defineXML(xml_str)
 
-            # Add graphics (VNC)
-            ET.SubElement(devices, 'graphics', type=graphics_type, port='-1', autoport='yes')
+            self.attach_iso(iso)
 
-            xml_str = ET.tostring(domain, encoding='unicode')
-
-            domain = self.connection.defineXML(xml_str)
+            self._domain.create()
+            input(f"VM template {self.name} booting. Connect with {graphics_type} to install, then, when done, press Enter here.")
+            self._domain.shutdown()
 
-            self.attach_iso(iso, self.connection)
+            self.detach_iso(iso)
 
-            domain.create()
-            input(f"VM template {self.name} booting. Connect with {graphics_type} to install, then, when done, press Enter here.")
-            domain.shutdown()
 
-            self.detach_iso(iso, self.connection)
+    def clone_disk(self, source: pathlib.Path):
+        # Disk images are the one thing worth the full fast path: FICLONE reflink, then copy_file_range, then plain shutil
+        # On btrfs/xfs that makes a 64 GB image a metadata-only copy
+        fast_copy(source, self.disk)
 
 
     def _build_and_verify_path(self, user: str, file_type: str, file: pathlib.Path = None) -> pathlib.Path:
         # Used to resolve file names to the intended destination with appropriate error checking
         # Returns the validated path
-        if user not in ["user", "root"]:
-            raise ValueError(f"User {user} is invalid. Valid choices are \"user\" or \"root\"")
-        if file_type not in ["executable", "file"]:
+        try:
+            directory = self._dirs[(user, file_type)]
+        except KeyError:
+            if user not in ("user", "root"):
+                raise ValueError(f"User {user} is invalid. Valid choices are \"user\" or \"root\"")
             raise ValueError(f"File type {file_type} is invalid. Valid choices are \"executable\" or \"file\"")
 
         # Can't check existence without breaking add_file logic; the rest is left to the top-level functions
-        return (self.path / f"{user}_{file_type}s" / file.name) if file is not None else (self.path / f"{user}_{file_type}s")
+        return (directory / file.name) if file is not None else directory
+
+
+    def _make_file_dir(self, directory: pathlib.Path):
+        # Silently recreate a missing file directory.
+        # The users shouldn't be getting their grubby fingers in my directory structure anyway...
+        # Only the leaf, though; a template that was never created is an error, not something to conjure up around one file
+        try:
+            directory.mkdir(exist_ok=True)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"VM template {self.name} does not exist.")
 
 
     def add_file(self, source_file: pathlib.Path, user: str, file_type: str):
-        if not source_file.exists():
+        path: pathlib.Path = self._build_and_verify_path(user, file_type, source_file)
+
+        self._make_file_dir(path.parent)
+
+        # The copy fails on a missing source anyway; no need to stat it first
+        try:
+            fast_copy(source_file, path)
+        except FileNotFoundError:
             raise FileNotFoundError(f"File {source_file} does not exist.")
+        self.__dict__.pop(f"{user}_{file_type}s", None)
 
-        path: pathlib.Path = self._build_and_verify_path(user, file_type, source_file)
 
-        # Silently recreate missing parent directories.
-        # The users shouldn't be getting their grubby fingers in my directory structure anyway...
-        if not path.parent.exists():
-            path.parent.mkdir()
+    def add_files(self, source_files: list, user: str, file_type: str):
+        # Files land by basename, so two sources with the same name would race to write the same destination
+        duplicates = sorted(name for name, count in collections.Counter(source_file.name for source_file in source_files).items() if count > 1)
+        if duplicates:
+            raise ValueError(f"Multiple files named {', '.join(duplicates)}; each file added at once needs a distinct name")
+
+        if len(source_files) == 1:
+            self.add_file(source_files[0], user, file_type)
+            return
+
+        # Create the destination once up front so the workers don't race each other to make it
+        self._make_file_dir(self._build_and_verify_path(user, file_type))
 
-        shutil.copy2(source_file, path)
+        # Each copy is independent, so overlap them rather than paying every file's open/copy/close in turn
+        with concurrent.futures.ThreadPoolExecutor(max_workers=COPY_WORKERS) as pool:
+            futures = [pool.submit(self.add_file, source_file, user, file_type) for source_file in source_files]
+            for future in futures:
+                future.result()
 
 
     def remove_file(self, file: pathlib.Path, user: str, file_type: str):
         path: pathlib.Path = self._build_and_verify_path(user, file_type, file)
 
-        if not path.exists():
+        try:
+            path.unlink()
+        except FileNotFoundError:
             raise FileNotFoundError(f"File {path} does not exist.")
-
-        path.unlink()
+        self.__dict__.pop(f"{user}_{file_type}s", None)
 
 
     def list_files(self, user: str, file_type: str) -> str:
         path: pathlib.Path = self._build_and_verify_path(user, file_type)
 
-        if not path.exists():
+        # DirEntry.path is already a string and is_file() answers from the directory read itself
+        try:
+            with os.scandir(path) as it:
+                return '\n'.join([entry.path for entry in it if entry.is_file(follow_symlinks=False)])
+        except FileNotFoundError:
             raise FileNotFoundError(f"The VM template {self.name} is corrupted and is missing {path}.")
 
-        return '\n'.join([x.as_posix() for x in path.iterdir()])
-
 
     def edit(self):
         tmp_file = self.config_file.parent / f"{self.config_file.name}.tmp"
 
-        shutil.copy2(self.config_file, tmp_file)
+        # A real copy, not a hardlink: editors that write in place (nano, vim's default backupcopy) would edit the original through the link,
+        # and a broken config would be live before it was ever validated
+        fast_copy(self.config_file, tmp_file)
+
+        spawn([get_editor(), tmp_file])
 
-        subprocess.run([get_editor(), tmp_file])
+        # fast_copy's copystat carried the mtime over, so an untouched tmp file still matches the original exactly; nothing to parse or apply
+        before, after = self.config_file.stat(), tmp_file.stat()
+        if (before.st_mtime_ns, before.st_size) == (after.st_mtime_ns, after.st_size):
+            tmp_file.unlink()
+            print(f"No changes made to {self.config_file}")
+            return
 
+        # libyaml reads straight from the binary file object; no intermediate str of the whole file
         try:
-            yaml.safe_load(tmp_file.read_text())
+            with tmp_file.open("rb") as f:
+                config = safe_load(f)
         except yaml.YAMLError as E:
             tmp_file.unlink()
             raise yaml.YAMLError(f"YAML error in config file; unable to apply\n{E}")
 
         tmp_file.replace(self.config_file)
+        self.config = config
         print(f"Configuration changes applied to {self.config_file}")
 
 
@@ -239,20 +393,23 @@ class VMTemplate:
 
         shutil.copy2(existing_key, self.ssh_key_dir / user)
         os.chmod(self.ssh_key_dir / user, 0o0600)
+        self.__dict__.pop("ssh_keyfiles", None)
 
 
     def remove_ssh_key(self, user):
-        if not user in [x.name for x in self.ssh_keyfiles]:
+        if not user in self.ssh_keyfiles:
             raise ValueError(f"No key file could be found for {user}")
 
         (self.ssh_key_dir / user).unlink()
+        self.__dict__.pop("ssh_keyfiles", None)
 
 
     def start(self, active_dir: pathlib.Path):
         # Start by getting new name
-        taken_names = [pathlib.Path(x).name for x in glob.glob(f"{active_dir.as_posix()}/{self.name}_*")]
+        prefix = f"{self.name}_"
+        taken_names = {name for name in scan_names(active_dir) if name.startswith(prefix)}
         for id in range(1000):
-            if f"{self.name}_{id}" not in taken_names:
+            if f"{prefix}{id}" not in taken_names:
                 break
 
         
\ No newline at end of file
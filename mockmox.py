@@ -2,17 +2,13 @@
 import os
 import click
 import pathlib
-import shutil
-import subprocess
 import logging
 import sys
-import libvirt
+import functools
 
 # Backend classes
-from classes.common import get_editor
-from classes.group import Group
-from classes.vm_template import VMTemplate
-from classes.config import load_config, DEFAULT_CONFIG_FILE, DEFAULT_SOCKET
+# Only the config file's default location is needed up front; everything else (and libvirt especially) is imported by the commands that use it
+from classes.config import DEFAULT_CONFIG_FILE
 
 # Yes, globals suck. Unfortunately, I'm not dealing with loading this in every subordinate function
 # And, because click is aggressively unhelpful when you need to load variables first...
@@ -27,10 +23,37 @@ try:
     idx = sys.argv.index('--libvirtd-connection')
     libvirtd_connection = sys.argv[idx + 1]
 except (ValueError, IndexError):
-    libvirtd_connection = DEFAULT_SOCKET
+    # Left unset so load_config can fall back to the config file's setting, then the default socket
+    libvirtd_connection = None
 
-CONFIG = load_config(config_file, libvirtd_connection)
-CONNECTION = libvirt.open(CONFIG["libvirtd_connection"])
+# Tab completion only needs the command tree, and it runs on every keypress; don't make it read the config
+if os.environ.get('_MOCKMOX_COMPLETE'):
+    config_file = None
+
+
+# Loaded the first time something asks for it, so --help, argument errors, and the placeholder commands never touch YAML
+@functools.lru_cache(maxsize=1)
+def get_config():
+    from classes.config import load_config
+    return load_config(config_file, libvirtd_connection)
+
+
+# Opened on first use; most commands never talk to the hypervisor
+@functools.lru_cache(maxsize=1)
+def get_connection():
+    import libvirt
+    return libvirt.open(get_config()["libvirtd_connection"])
+
+
+# Used by the file commands; create and delete build their own VMTemplate
+def _template(name):
+    from classes.vm_template import VMTemplate
+    return VMTemplate.get(name, get_config()['vm_template_dir'])
+
+
+# Shared by every file command rather than building a new Choice per option
+_USER_CHOICE = click.Choice(('user', 'root'))
+_FILE_TYPE_CHOICE = click.Choice(('file', 'executable'))
 
 
 logging.basicConfig(
@@ -39,8 +62,8 @@ logging.basicConfig(
 )
 
 @click.group()
-@click.option('--libvirtd-connection', default="qemu:///system", help="Libvirtd hypervisor connection string.")
-@click.option('--config-file', type=click.Path(), default=DEFAULT_CONFIG_FILE, help="Path to config file.")
+@click.option('--libvirtd-connection', default=None, help="Libvirtd hypervisor connection string. Defaults to the config file's setting, then qemu:///system.")
+@click.option('--config-file', type=click.Path(path_type=pathlib.Path), default=DEFAULT_CONFIG_FILE, help="Path to config file.")
 @click.option('--verbose', is_flag=True, help="Enable verbose output.")
 @click.pass_context
 def cli(ctx, libvirtd_connection, config_file, verbose):
@@ -64,24 +87,24 @@ def vm():
 
 @vm.command()
 @click.argument('name')
-@click.option('-s', '--size', default=CONFIG['vm_default_disk_size'], help=f"Disk size in GB (default: {CONFIG['vm_default_disk_size']})")
-@click.option('-c', '--cpus', default=CONFIG['vm_default_cpus'], help=f"Number of CPUs (default: {CONFIG['vm_default_cpus']})")
-@click.option('-m', '--memory', default=CONFIG['vm_default_memory'], help=f"Memory size in MB (default: {CONFIG['vm_default_memory']}")
-@click.option('--existing-qcow2', type=click.Path(), help=f"Use existing disk image")
-@click.option('-i', '--iso', type=click.Path(), help="Path to installation ISO")
+# Callable defaults are only evaluated when the option is actually left out, so the config is read then and not at import
+@click.option('-s', '--size', type=int, default=lambda: get_config()['vm_default_disk_size'], help="Disk size in GB (default: defaults.vm_disk_size in the config file, or 64)")
+@click.option('-c', '--cpus', type=int, default=lambda: get_config()['vm_default_cpus'], help="Number of CPUs (default: defaults.vm_cpus in the config file, or 4)")
+@click.option('-m', '--memory', type=int, default=lambda: get_config()['vm_default_memory'], help="Memory size in MB (default: defaults.vm_memory in the config file, or 8192)")
+@click.option('--existing-qcow2', type=click.Path(path_type=pathlib.Path), help=f"Use existing disk image")
+@click.option('-i', '--iso', type=click.Path(path_type=pathlib.Path), help="Path to installation ISO")
 def create(name, size, cpus, memory, existing_qcow2, iso):
     """Create a new VM template."""
-    vm = VMTemplate(name, CONFIG['vm_template_dir'], CONNECTION)
-    existing_disk = pathlib.Path(existing_qcow2) if existing_qcow2 else None
-    iso_path = pathlib.Path(iso) if iso else None
+    from classes.vm_template import VMTemplate
+    vm = VMTemplate(name, get_config()['vm_template_dir'], get_connection())
     vm.create(
         disk_size=size,
         cpus=cpus,
         memory=memory,
-        existing_disk_image=existing_disk,
-        iso=iso_path)
+        existing_disk_image=existing_qcow2,
+        iso=iso)
 
-    connection.close()
+    get_connection().close()
 
     click.echo(f"VM '{name}' created.")
 
@@ -91,8 +114,9 @@ def create(name, size, cpus, memory, existing_qcow2, iso):
 @click.argument('--acknowledge', type=bool)
 def delete(name, acknowledge):
     """Delete a VM template."""
-    vm = VMTemplate(name, CONFIG['vm_template_dir'], delete=True)
-    vm.delete(CONFIG['vm_group_dir'], acknowledge)
+    from classes.vm_template import VMTemplate
+    vm = VMTemplate(name, get_config()['vm_template_dir'], delete=True)
+    vm.delete(get_config()['vm_group_dir'], acknowledge)
     click.echo(f"Deleted VM '{name}'.")
 
 
@@ -100,42 +124,43 @@ def delete(name, acknowledge):
 @click.argument('name')
 def edit(name):
     """Edit a VM template's configuration."""
-    vm = VMTemplate(name, CONFIG['vm_template_dir'])
+    vm = _template(name)
     vm.edit()
 
 
 @vm.command('list-files')
 @click.argument('name')
-@click.option('-u', '--user', type=click.Choice(['user', 'root']), required=True, help="List user or root files.")
-@click.option('-t', '--type', type=click.Choice(['file', 'executable']), required=True, help="File or executable?")
+@click.option('-u', '--user', type=_USER_CHOICE, required=True, help="List user or root files.")
+@click.option('-t', '--type', type=_FILE_TYPE_CHOICE, required=True, help="File or executable?")
 def list_files(name, user, type):
     """List files/scripts owned by a VM template."""
-    vm = VMTemplate(name, CONFIG['vm_template_dir'])
+    vm = _template(name)
     files = vm.list_files(user, type)
     click.echo(files)
 
 
 @vm.command('add-file')
 @click.argument('name')
-@click.argument('source_file', type=click.Path(exists=True))
-@click.option('-u', '--user', type=click.Choice(['user', 'root']), required=True, help="Owner of the file.")
-@click.option('-t', '--type', type=click.Choice(['file', 'executable']), required=True, help="File type.")
-def add_file(name, source_file, user, type):
-    """Add a file or executable to a VM template."""
-    vm = VMTemplate(name, CONFIG['vm_template_dir'])
-    vm.add_file(pathlib.Path(source_file), user, type)
-    click.echo(f"Added {type} '{source_file}' to VM '{name}' as {user}.")
+@click.argument('source_files', nargs=-1, required=True, type=click.Path(exists=True, path_type=pathlib.Path))
+@click.option('-u', '--user', type=_USER_CHOICE, required=True, help="Owner of the file.")
+@click.option('-t', '--type', type=_FILE_TYPE_CHOICE, required=True, help="File type.")
+def add_file(name, source_files, user, type):
+    """Add one or more files or executables to a VM template."""
+    vm = _template(name)
+    vm.add_files(source_files, user, type)
+    for source_file in source_files:
+        click.echo(f"Added {type} '{source_file}' to VM '{name}' as {user}.")
 
 
 @vm.command('remove-file')
 @click.argument('name')
-@click.argument('source_file', type=click.Path())
-@click.option('-u', '--user', type=click.Choice(['user', 'root']), required=True)
-@click.option('-t', '--type', type=click.Choice(['file', 'executable']), required=True)
+@click.argument('source_file', type=click.Path(path_type=pathlib.Path))
+@click.option('-u', '--user', type=_USER_CHOICE, required=True)
+@click.option('-t', '--type', type=_FILE_TYPE_CHOICE, required=True)
 def remove_file(name, source_file, user, type):
     """Remove a file or executable from a VM template."""
-    vm = VMTemplate(name, CONFIG['vm_template_dir'])
-    vm.remove_file(pathlib.Path(source_file), user, type)
+    vm = _template(name)
+    vm.remove_file(source_file, user, type)
     click.echo(f"Removed {type} '{source_file}' from VM '{name}' as {user}.")
 
 
@@ -151,10 +176,9 @@ def group():
 @click.argument('name')
 def create(name):
     """Create a new group."""
-    grp = Group(name, CONFIG['vm_group_dir'], CONFIG['vm_template_dir'])
-    grp.path.mkdir(parents=True, exist_ok=False)
-    grp.snapshot_dir.mkdir()
-    grp.vm_template_dir.mkdir()
+    from classes.group import Group
+    grp = Group(name, get_config()['vm_group_dir'], get_config()['vm_template_dir'])
+    grp.create()
     click.echo(f"Group '{name}' created.")
 
 
@@ -162,7 +186,8 @@ def create(name):
 @click.argument('name')
 def delete(name):
     """Delete a group."""
-    grp = Group(name, CONFIG['vm_group_dir'], CONFIG['vm_template_dir'])
+    from classes.group import Group
+    grp = Group(name, get_config()['vm_group_dir'], get_config()['vm_template_dir'])
     grp.delete()
     click.echo(f"Deleted group '{name}'.")
 
@@ -172,10 +197,10 @@ def delete(name):
 @click.argument('group_name')
 def add(vm_name, group_name):
     """Add a VM template to a group."""
-    grp = Group(group_name, CONFIG['vm_group_dir'], CONFIG['vm_template_dir'])
-    vm_path = CONFIG['vm_template_dir'] / vm_name
-    dest = grp.vm_template_dir / vm_name
-    shutil.copytree(vm_path, dest)
+    from classes.group import Group
+    grp = Group(group_name, get_config()['vm_group_dir'], get_config()['vm_template_dir'])
+    # Disk images are symlinked rather than copied; everything else goes through the reflink-aware fast_copy
+    grp.add_vm_template(vm_name)
     click.echo(f"Added VM '{vm_name}' to group '{group_name}'.")
 
 
@@ -184,9 +209,9 @@ def add(vm_name, group_name):
 @click.argument('group_name')
 def remove(vm_name, group_name):
     """Remove a VM template from a group."""
-    grp = Group(group_name, CONFIG['vm_group_dir'], CONFIG['vm_template_dir'])
-    dest = grp.vm_template_dir / vm_name
-    shutil.rmtree(dest)
+    from classes.group import Group
+    grp = Group(group_name, get_config()['vm_group_dir'], get_config()['vm_template_dir'])
+    grp.delete_vm_template(vm_name)
     click.echo(f"Removed VM '{vm_name}' from group '{group_name}'.")
 
 
@@ -201,11 +226,15 @@ def instantiate(name):
 @click.argument('name')
 def edit(name):
     """Edit a group's configuration."""
-    grp = Group(name, CONFIG['vm_group_dir'], CONFIG['vm_template_dir'])
-    config_file = grp.path / "config.yaml"
-    if not config_file.exists():
-        config_file.write_text("# Group configuration\n")
-    subprocess.run([get_editor(), str(config_file)])
+    from classes.common import get_editor, spawn
+    from classes.group import Group
+    grp = Group(name, get_config()['vm_group_dir'], get_config()['vm_template_dir'])
+    if not grp.config_file.exists():
+        # Seed through a tmp file and rename, so nothing ever sees a half-written config
+        tmp_file = grp.config_file.with_suffix(".yaml.tmp")
+        tmp_file.write_text("# Group configuration\n")
+        os.replace(tmp_file, grp.config_file)
+    spawn([get_editor(), str(grp.config_file)])
 
 
 # ====================
@@ -257,6 +286,22 @@ def ssh(instance_name, vm_name):
     click.echo(f"SSH into VM '{vm_name}' in instance '{instance_name}'.")
 
 
+@instance.command()
+@click.argument('name')
+@click.option('-a', '--action', type=click.Choice(('stop', 'suspend', 'resume')), required=True, help="Action to apply to each VM.")
+def bulk(name, action):
+    """Stop, suspend, or resume many VMs in an instance at once. VM names are read from stdin, one per line."""
+    # One process and one write for the lot, instead of an interpreter start and a flush per VM from a shell loop
+    verb = {'stop': "Stopping", 'suspend': "Suspending", 'resume': "Resuming"}[action]
+    out = []
+    for line in sys.stdin:
+        vm = line.strip()
+        if vm:
+            out.append(f"{verb} instance '{name}', target: {vm}")
+    if out:
+        click.echo("\n".join(out))
+
+
 # ====================
 # List command
 # ====================
@@ -270,27 +315,40 @@ def list(type):
 @cli.command()
 def install():
     """Install the script"""
-    base_dir = pathlib.Path(CONFIG["directories"]["base_dir"])
-    if not base_dir.parent.exists():
-        raise FileNotFoundError(f"The parent directory of the base directory {base_dir}, specified in {config_file}, does not exist.")
-
-    script_location = pathlib.Path(CONFIG["directories"]["script_location"])
-    if not script_location.parent.exists():
+    import shutil
+    import compileall
+    base_dir = pathlib.Path(get_config()["directories"]["base_dir"])
+    script_location = pathlib.Path(get_config()["directories"]["script_location"])
+
+    # Checked up front so a bad script location doesn't leave a half-finished install behind
+    try:
+        os.stat(script_location.parent)
+    except FileNotFoundError:
         raise FileNotFoundError(
             f"The parent directory of the script location {script_location} specified in {config_file}, does not exist.")
 
-    base_dir.mkdir()
-    (base_dir / "groups").mkdir()
-    (base_dir / "vm_templates").mkdir()
-    (base_dir / "active").mkdir()
-    (base_dir / "suspended").mkdir()
-    (base_dir / "defaults").mkdir()
+    # mkdir already fails on a missing parent; no separate stat needed for the base directory
+    try:
+        base_dir.mkdir()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"The parent directory of the base directory {base_dir}, specified in {config_file}, does not exist.")
+
+    for subdir in ("groups", "vm_templates", "active", "suspended", "defaults"):
+        os.makedirs(base_dir / subdir, exist_ok=False)
+
+    shutil.copytree(pathlib.Path(__file__).parent, base_dir, dirs_exist_ok=True)
+
+    # Byte-compile the backend now, while we can write to the base directory
+    # Otherwise users without write access there recompile every module in memory on every run
+    # Not -OO: that strips docstrings, and click builds the help text out of them
+    compileall.compile_dir(base_dir, quiet=1)
 
-    shutil.copytree(pathlib.Path(__file__).parent, base_dir)
     os.symlink(base_dir / "mockmox.py", script_location)
 
 
+def main():
+    cli()
 
 
 if __name__ == "__main__":
-    cli()
+    main()